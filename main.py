@@ -1,12 +1,288 @@
 import gradio as gr
+from collections import deque
+from io import BytesIO
 from pathlib import Path
+import errno
+import json
+import mmap
+import os
 import struct
 import subprocess
 import shutil
+import threading
 from PIL import Image
 
+# Try turbojpeg (fast path)
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420, TJFLAG_FASTDCT  # type: ignore
+    _TJ = TurboJPEG()  # shared by the merge threads, see main_images.py
+except Exception:
+    _TJ = None
+
+
+def _probe_video_streams(avi_file):
+    probe_cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v",
+        "-show_entries", "stream=width,height,r_frame_rate",
+        "-of", "json",
+        str(avi_file)
+    ]
+    result = subprocess.run(probe_cmd, capture_output=True, text=True)
+    try:
+        return json.loads(result.stdout).get("streams", [])
+    except ValueError:
+        return []
+
+
+def _parse_framerate(framerate_raw):
+    framerate_raw = framerate_raw.strip()
+    if '/' in framerate_raw:
+        num, denom = map(int, framerate_raw.split('/'))
+        return round(num / denom, 3) if denom != 0 else 30
+    return float(framerate_raw) if framerate_raw else 30
+
+
+def _x264_args(preset, crf):
+    return [
+        "-c:v", "libx264", "-crf", str(int(crf)), "-preset", preset,
+        "-tune", "fastdecode",
+        "-x264-params", "threads=0:lookahead-threads=0",
+        "-pix_fmt", "yuv420p",
+    ]
+
+
+def _jpeg_size(path):
+    # Reads only the JPEG header, no pixel decode
+    with Image.open(path) as im:
+        return im.size
+
 
-def extract_and_create_sbs_with_audio(input_video_or_folder, output_folder):
+# Windows-only flags (binary mode, sequential-access cache hint); 0 elsewhere
+_WRITE_FLAGS = (
+    os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    | getattr(os, "O_BINARY", 0) | getattr(os, "O_SEQUENTIAL", 0)
+)
+
+
+def _write_frame(path, data):
+    fd = os.open(path, _WRITE_FLAGS, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+def _demux_avi_frames(avi_file, temp_folder):
+    # Stream-copy both MJPEG streams to numbered JPEGs in one ffmpeg run
+    cmd_demux = [
+        "ffmpeg", "-y",
+        "-i", str(avi_file),
+        "-map", "0:v:0", "-c:v", "copy", "-f", "image2", "-start_number", "0",
+        str(temp_folder / "left_%04d.jpg"),
+        "-map", "0:v:1", "-c:v", "copy", "-f", "image2", "-start_number", "0",
+        str(temp_folder / "right_%04d.jpg"),
+    ]
+    result = subprocess.run(cmd_demux, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    return len(list(temp_folder.glob("left_*.jpg"))), len(list(temp_folder.glob("right_*.jpg")))
+
+
+_CHUNK_HEADER = struct.Struct('<4sI')
+
+
+def _find_movi(mm):
+    # Jump straight to the 'LIST....movi' payload; returns (start, end) or None
+    pos = mm.find(b'movi', 12)
+    while pos != -1:
+        if pos >= 8 and mm[pos - 8:pos - 4] == b'LIST':
+            movi_size = struct.unpack_from('<I', mm, pos - 4)[0]
+            return pos + 4, min(pos + movi_size, len(mm))
+        pos = mm.find(b'movi', pos + 4)
+    return None
+
+
+def _index_movi_fast(mm, start, end):
+    # Fuji W3 layout: a flat run of 00dc (left) / 01wb (audio) / 02dc (right) chunks.
+    # Returns None on any nested LIST/RIFF so the generic walker takes over.
+    left_frames = []
+    right_frames = []
+    unpack = _CHUNK_HEADER.unpack_from
+    pos = start
+    while pos + 8 <= end:
+        chunk_id, chunk_size = unpack(mm, pos)
+        if chunk_id == b'00dc':
+            left_frames.append((pos + 8, chunk_size))
+        elif chunk_id == b'02dc':
+            right_frames.append((pos + 8, chunk_size))
+        elif chunk_id == b'LIST' or chunk_id == b'RIFF':
+            return None
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return left_frames, right_frames
+
+
+def _index_avi_generic(mm):
+    # Full RIFF walk; enters every LIST, including 'rec ' groups inside movi
+    left_frames = []
+    right_frames = []
+    end = len(mm)
+    movi_end = None
+    pos = 12
+    while pos + 8 <= end:
+        if movi_end is not None and pos >= movi_end:
+            break
+        chunk_id, chunk_size = _CHUNK_HEADER.unpack_from(mm, pos)
+
+        if chunk_id == b'LIST':
+            if movi_end is None and mm[pos + 8:pos + 12] == b'movi':
+                movi_end = min(pos + 8 + chunk_size, end)
+            # Descend into the list's sub-chunks
+            pos += 12
+            continue
+
+        if movi_end is not None:
+            if chunk_id == b'00dc':
+                left_frames.append((pos + 8, chunk_size))
+            elif chunk_id == b'02dc':
+                right_frames.append((pos + 8, chunk_size))
+        pos += 8 + chunk_size + (chunk_size % 2)
+    return left_frames, right_frames
+
+
+def _extract_avi_frames(avi_file, temp_folder):
+    # Index the frames on a read-only mmap, then write each JPEG payload to disk
+    # as a zero-copy memoryview slice.
+    with open(avi_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 12:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            # Linux/macOS: one front-to-back pass -> aggressive read-ahead
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        mv = memoryview(mm)
+        try:
+            riff_id, riff_size, riff_format = struct.unpack_from('<4sI4s', mm, 0)
+            if riff_id != b'RIFF' or riff_format != b'AVI ':
+                return None
+
+            movi = _find_movi(mm)
+            frames = _index_movi_fast(mm, *movi) if movi is not None else None
+            if frames is None:
+                frames = _index_avi_generic(mm)
+            left_frames, right_frames = frames
+
+            # Interleaved, i.e. roughly in file order
+            for idx in range(max(len(left_frames), len(right_frames))):
+                for name, index in (("left", left_frames), ("right", right_frames)):
+                    if idx < len(index):
+                        offset, size = index[idx]
+                        with mv[offset:offset + size] as frame_data:
+                            _write_frame(temp_folder / f"{name}_{idx:04d}.jpg", frame_data)
+        finally:
+            # memoryview must be released before closing mmap on Windows
+            mv.release()
+            mm.close()
+
+    return len(left_frames), len(right_frames)
+
+
+def _merge_sbs_frame(left_img_path, right_img_path, canvas=None):
+    # Returns the encoded SBS JPEG and the canvas to reuse for the next frame
+    if _TJ is not None:
+        arr_l = _TJ.decode(left_img_path.read_bytes(), pixel_format=TJPF_RGB)
+        arr_r = _TJ.decode(right_img_path.read_bytes(), pixel_format=TJPF_RGB)
+        left_h, left_w = arr_l.shape[:2]
+        right_h, right_w = arr_r.shape[:2]
+
+        # Reuse the canvas between frames; the per-eye heights can change while the
+        # overall shape doesn't, so the padding under the shorter eye is re-zeroed
+        shape = (max(left_h, right_h), left_w + right_w, 3)
+        if canvas is None or canvas.shape != shape:
+            canvas = np.zeros(shape, dtype=np.uint8)
+        canvas[:left_h, :left_w] = arr_l
+        canvas[left_h:, :left_w] = 0
+        canvas[:right_h, left_w:] = arr_r
+        canvas[right_h:, left_w:] = 0
+        # x264 encodes yuv420p anyway, so 4:2:0 + fast DCT here loses nothing visible
+        data = _TJ.encode(canvas, quality=95, pixel_format=TJPF_RGB,
+                          jpeg_subsample=TJSAMP_420, flags=TJFLAG_FASTDCT)
+        return data, canvas
+
+    # Fallback to Pillow
+    left_img = Image.open(left_img_path)
+    right_img = Image.open(right_img_path)
+
+    new_width = left_img.width + right_img.width
+    new_height = max(left_img.height, right_img.height)
+
+    sbs_img = Image.new('RGB', (new_width, new_height))
+    sbs_img.paste(left_img, (0, 0))
+    sbs_img.paste(right_img, (left_img.width, 0))
+    out = BytesIO()
+    sbs_img.save(out, "JPEG", quality=95, subsampling=2)
+    return out.getvalue(), canvas
+
+
+def _merged_frames(left_paths, right_paths):
+    # Merge on a thread pool and yield the SBS JPEGs in frame order,
+    # keeping only a small window of encoded frames in memory
+    from concurrent.futures import ThreadPoolExecutor
+    buffers = threading.local()
+
+    def _merge_one(idx):
+        # One canvas per worker thread, reused across its frames
+        canvas = getattr(buffers, "canvas", None)
+        data, buffers.canvas = _merge_sbs_frame(left_paths[idx], right_paths[idx], canvas)
+        return data
+
+    workers = os.cpu_count() or 4
+    # JPEG decode/encode is in C (releases GIL) -> threads help
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for idx in range(len(left_paths)):
+            pending.append(ex.submit(_merge_one, idx))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _pipe_closed(exc):
+    # ffmpeg exited: EPIPE on POSIX, EINVAL on Windows (same check as subprocess._stdin_write)
+    return isinstance(exc, BrokenPipeError) or exc.errno in (errno.EPIPE, errno.EINVAL)
+
+
+def _pipe_frames(cmd, frames):
+    # Feed JPEG frames to an ffmpeg reading image2pipe from stdin; returns its exit code
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for data in frames:
+            proc.stdin.write(data)
+    except OSError as e:
+        # ffmpeg quit early; nothing more to feed
+        if not _pipe_closed(e):
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError as e:
+            if not _pipe_closed(e):
+                raise
+        finally:
+            proc.wait()
+    return proc.returncode
+
+
+X264_PRESETS = [
+    "ultrafast", "superfast", "veryfast", "faster", "fast",
+    "medium", "slow", "slower", "veryslow",
+]
+
+
+def extract_and_create_sbs_with_audio(input_video_or_folder, output_folder, preset="veryfast", crf=18):
     try:
         input_path = Path(input_video_or_folder)
         output_path = Path(output_folder)
@@ -27,137 +303,101 @@ def extract_and_create_sbs_with_audio(input_video_or_folder, output_folder):
 
         for avi_file in avi_files:
             temp_folder = output_path / f"{avi_file.stem}_tmp"
-            combined_folder = temp_folder / "sbs_frames"
-            combined_folder.mkdir(parents=True, exist_ok=True)
-
-            # Extract framerate using ffprobe
-            probe_cmd = [
-                "ffprobe", "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=r_frame_rate",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                str(avi_file)
-            ]
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            framerate_raw = result.stdout.strip()
-            if '/' in framerate_raw:
-                num, denom = map(int, framerate_raw.split('/'))
-                framerate = round(num / denom, 3) if denom != 0 else 30
-            else:
-                framerate = float(framerate_raw) if framerate_raw else 30
-
-            # Extract audio
-            audio_file = temp_folder / "audio.m4a"
-            audio_cmd = [
-                "ffmpeg", "-y", "-i", str(avi_file),
-                "-vn", "-acodec", "aac", "-b:a", "192k", str(audio_file)
-            ]
-            subprocess.run(audio_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-            left_count = 0
-            right_count = 0
+            # Probe the video streams (size + framerate) using ffprobe
+            streams = _probe_video_streams(avi_file)
+            framerate = _parse_framerate(streams[0].get("r_frame_rate", "") if streams else "")
+            final_output = output_path / f"{avi_file.stem}_SBS.mp4"
 
-            # Extract frames
-            with open(avi_file, 'rb') as f:
-                riff_header = f.read(12)
-                riff_id, riff_size, riff_format = struct.unpack('<4sI4s', riff_header)
-                if riff_id != b'RIFF' or riff_format != b'AVI ':
-                    results.append(f"Skipping {avi_file.name}: Not a valid AVI.")
+            if len(streams) >= 2 and streams[0].get("height") == streams[1].get("height"):
+                # ffmpeg sees both eyes as separate streams: stack them straight from the AVI
+                cmd_video = [
+                    "ffmpeg", "-y",
+                    "-i", str(avi_file),
+                    "-filter_complex", "[0:v:0][0:v:1]hstack=inputs=2:shortest=1[v]",
+                    "-map", "[v]",
+                    "-map", "0:a?",
+                    *_x264_args(preset, crf),
+                    "-c:a", "aac", "-b:a", "192k",
+                    str(final_output)
+                ]
+                result = subprocess.run(cmd_video, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if result.returncode == 0:
+                    results.append(f"✅ {avi_file.name} → {final_output.name} ({framerate} FPS)")
                     continue
+                # ffmpeg could not stack the streams: fall back to extracting the frames
 
-                while True:
-                    pos = f.tell()
-                    header = f.read(8)
-                    if not header or len(header) < 8:
-                        break
-
-                    chunk_id_bytes, chunk_size = struct.unpack('<4sI', header)
-                    chunk_id = chunk_id_bytes.decode('ascii', errors='ignore').strip()
-
-                    if chunk_id == 'LIST':
-                        list_type = f.read(4)
-                        subtype = list_type.decode('ascii', errors='ignore').strip()
-
-                        if subtype == 'movi':
-                            movi_end = pos + 8 + chunk_size
-                            while f.tell() < movi_end:
-                                frame_header = f.read(8)
-                                if not frame_header or len(frame_header) < 8:
-                                    break
-
-                                frame_id_bytes, frame_size = struct.unpack('<4sI', frame_header)
-                                frame_id = frame_id_bytes.decode('ascii', errors='ignore').strip()
-
-                                frame_data = f.read(frame_size)
-
-                                if frame_id == '00dc':
-                                    left_file = temp_folder / f"left_{left_count:04d}.jpg"
-                                    with open(left_file, 'wb') as out_file:
-                                        out_file.write(frame_data)
-                                    left_count += 1
-
-                                elif frame_id == '02dc':
-                                    right_file = temp_folder / f"right_{right_count:04d}.jpg"
-                                    with open(right_file, 'wb') as out_file:
-                                        out_file.write(frame_data)
-                                    right_count += 1
-
-                                if frame_size % 2 == 1:
-                                    f.seek(1, 1)
-                            break
-                    else:
-                        f.seek(chunk_size + (chunk_size % 2), 1)
+            temp_folder.mkdir(parents=True, exist_ok=True)
+
+            # Extract frames: ffmpeg's demuxer when it sees both eyes, else our RIFF parser
+            counts = _demux_avi_frames(avi_file, temp_folder) if len(streams) >= 2 else None
+            if counts is None or min(counts) == 0:
+                counts = _extract_avi_frames(avi_file, temp_folder)
+            if counts is None:
+                results.append(f"Skipping {avi_file.name}: Not a valid AVI.")
+                continue
+            left_count, right_count = counts
 
             min_frames = min(left_count, right_count)
             if min_frames == 0:
                 results.append(f"Extraction failed: {avi_file.name}: Left {left_count}, Right {right_count}")
                 continue
 
-            # Merge images using PIL
-            for idx in range(min_frames):
-                left_img_path = temp_folder / f"left_{idx:04d}.jpg"
-                right_img_path = temp_folder / f"right_{idx:04d}.jpg"
-                combined_file = combined_folder / f"sbs_{idx:04d}.jpg"
-
-                left_img = Image.open(left_img_path)
-                right_img = Image.open(right_img_path)
-
-                new_width = left_img.width + right_img.width
-                new_height = max(left_img.height, right_img.height)
-
-                sbs_img = Image.new('RGB', (new_width, new_height))
-                sbs_img.paste(left_img, (0, 0))
-                sbs_img.paste(right_img, (left_img.width, 0))
-                sbs_img.save(combined_file, quality=95)
-
             # Create video
-            sbs_video = output_path / f"{avi_file.stem}_SBS_noaudio.mp4"
+            _, left_height = _jpeg_size(temp_folder / "left_0000.jpg")
+            _, right_height = _jpeg_size(temp_folder / "right_0000.jpg")
+
+            if left_height == right_height:
+                # Same height: let ffmpeg stack the extracted JPEGs directly (no intermediate SBS frames)
+                video_inputs = [
+                    "-framerate", str(framerate),
+                    "-i", str(temp_folder / "left_%04d.jpg"),
+                    "-framerate", str(framerate),
+                    "-i", str(temp_folder / "right_%04d.jpg"),
+                ]
+                video_map = [
+                    "-filter_complex", "[0:v][1:v]hstack=inputs=2[v]",
+                    "-map", "[v]",
+                    "-frames:v", str(min_frames),
+                ]
+                sbs_frames = None
+            else:
+                # Heights differ: merge frames with TurboJPEG/PIL (pads the shorter eye)
+                # and pipe them straight into ffmpeg -> no SBS frames on disk
+                left_paths = [temp_folder / f"left_{idx:04d}.jpg" for idx in range(min_frames)]
+                right_paths = [temp_folder / f"right_{idx:04d}.jpg" for idx in range(min_frames)]
+                sbs_frames = _merged_frames(left_paths, right_paths)
+
+                video_inputs = [
+                    "-f", "image2pipe",
+                    "-framerate", str(framerate),
+                    "-c:v", "mjpeg",
+                    "-i", "-",
+                ]
+                video_map = ["-map", "0:v"]
+
+            # Encode video and take the audio straight from the AVI in a single ffmpeg run
+            audio_input = video_inputs.count("-i")
             cmd_video = [
                 "ffmpeg", "-y",
-                "-framerate", str(framerate),
-                "-i", str(combined_folder / "sbs_%04d.jpg"),
-                "-c:v", "libx264", "-crf", "18", "-preset", "medium",
-                "-pix_fmt", "yuv420p",
-                str(sbs_video)
-            ]
-            subprocess.run(cmd_video, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            # Mux audio
-            final_output = output_path / f"{avi_file.stem}_SBS.mp4"
-            cmd_mux = [
-                "ffmpeg", "-y",
-                "-i", str(sbs_video),
-                "-i", str(audio_file),
-                "-c:v", "copy",
-                "-c:a", "aac",
+                *video_inputs,
+                "-i", str(avi_file),
+                *video_map,
+                "-map", f"{audio_input}:a?",
+                *_x264_args(preset, crf),
+                "-c:a", "aac", "-b:a", "192k",
                 str(final_output)
             ]
-            subprocess.run(cmd_mux, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if sbs_frames is None:
+                returncode = subprocess.run(cmd_video, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+            else:
+                returncode = _pipe_frames(cmd_video, sbs_frames)
 
             shutil.rmtree(temp_folder, ignore_errors=True)
-            if sbs_video.exists():
-                sbs_video.unlink()
 
+            if returncode != 0:
+                results.append(f"Encoding failed: {avi_file.name}: ffmpeg exit code {returncode}")
+                continue
             results.append(f"✅ {avi_file.name} → {final_output.name} ({framerate} FPS)")
 
         return "\n".join(results)
@@ -172,6 +412,8 @@ def main():
         inputs=[
             gr.Textbox(label="Input AVI File or Folder", placeholder="C:/Videos/input.avi or folder"),
             gr.Textbox(label="Output Folder", placeholder="C:/Videos/Output"),
+            gr.Dropdown(label="x264 Preset (faster = bigger files)", choices=X264_PRESETS, value="veryfast"),
+            gr.Slider(label="CRF (lower = higher quality)", minimum=0, maximum=51, step=1, value=18),
         ],
         outputs=gr.Textbox(label="Status"),
         title="Fuji 3D → SBS MP4 Batch Converter",
@@ -1,33 +1,55 @@
 # fast_mpo_to_sbs_unreal.py
-# pip install pillow gradio turbojpeg (turbojpeg optional but fast)
+# pip install pillow gradio turbojpeg pyvips (turbojpeg/pyvips optional but fast)
 from pathlib import Path
 from io import BytesIO
 from typing import List, Tuple, Optional
 import mmap
 import os
+import struct
 import gradio as gr
+import numpy as np
 from PIL import Image, ImageOps
 
 # Try turbojpeg (fast path)
 try:
-    from turbojpeg import TurboJPEG  # type: ignore
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420, TJFLAG_FASTDCT  # type: ignore
+    # Safe to share across worker threads: every decode/encode call opens and
+    # destroys its own tjhandle, the instance only holds the loaded library.
     _TJ = TurboJPEG()
 except Exception:
     _TJ = None
 
+# Try pyvips (fused decode -> join -> encode pipeline)
+try:
+    import pyvips  # type: ignore
+    _VIPS = pyvips
+except Exception:
+    _VIPS = None
+
 # ---- EXACT Unreal-style marker scan ----
-def parse_mpo_for_second_image(buf: memoryview) -> Tuple[int, int]:
-    pattern1 = (0xFF, 0xD8, 0xFF, 0xE1)
-    pattern2 = (0xFF, 0xD8, 0xFF, 0xE0)
+_SCAN_BLOCK = 1 << 20  # bytes compared per vectorized pass
+
+def _find_soi_markers(buf: memoryview, limit: int) -> List[int]:
+    # FF D8 FF E0/E1 via shifted byte compares over one block at a time,
+    # so we can stop early without scanning (or allocating for) the whole file.
+    # Kept separate so no numpy view of buf outlives this call (mmap close).
+    a = np.frombuffer(buf, dtype=np.uint8)
+    n = a.shape[0] - 3
     offsets: List[int] = []
+    start = 0
+    while start < n and len(offsets) < limit:
+        stop = min(start + _SCAN_BLOCK, n)
+        m = stop - start
+        w = a[start:stop + 3]
+        hit = (w[:m] == 0xFF) & (w[1:m + 1] == 0xD8) & (w[2:m + 2] == 0xFF) & ((w[3:m + 3] | 1) == 0xE1)
+        offsets.extend((np.flatnonzero(hit) + start).tolist())
+        start = stop
+    return offsets[:limit]
+
+def parse_mpo_for_second_image(buf: memoryview) -> Tuple[int, int]:
+    # Only the 2nd and 3rd markers are used -> stop after three
+    offsets = _find_soi_markers(buf, 3)
     n = len(buf)
-    i = 0
-    while i <= n - 4:
-        b0, b1, b2, b3 = buf[i], buf[i + 1], buf[i + 2], buf[i + 3]
-        if (b0, b1, b2, b3) == pattern1 or (b0, b1, b2, b3) == pattern2:
-            offsets.append(i)
-            i += 3
-        i += 1
     if len(offsets) < 2:
         raise ValueError("Could not find enough JPEG markers in the MPO file.")
     start = offsets[1]
@@ -35,56 +57,116 @@ def parse_mpo_for_second_image(buf: memoryview) -> Tuple[int, int]:
     return start, length
 
 # ---- Decoding (fast with TurboJPEG, else Pillow) ----
-from PIL import Image
-import numpy as np
 
-def _decode_jpeg_slice(buf: memoryview) -> Image.Image:
+# ---- EXIF orientation straight from the APP1 header (no decode, no rotated copy) ----
+def _exif_orientation(buf: memoryview) -> int:
+    n = len(buf)
+    i = 2  # skip SOI
+    try:
+        while i + 4 <= n and buf[i] == 0xFF:
+            marker = buf[i + 1]
+            if marker in (0xD9, 0xDA):  # EOI / SOS: headers are over
+                break
+            seg_len = (buf[i + 2] << 8) | buf[i + 3]
+            if marker == 0xE1 and bytes(buf[i + 4:i + 10]) == b"Exif\0\0":
+                tiff = bytes(buf[i + 10:i + 2 + seg_len])
+                endian = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+                if endian is None:
+                    return 1
+                ifd = struct.unpack_from(endian + "I", tiff, 4)[0]
+                count = struct.unpack_from(endian + "H", tiff, ifd)[0]
+                for k in range(count):
+                    entry = ifd + 2 + 12 * k
+                    tag = struct.unpack_from(endian + "H", tiff, entry)[0]
+                    if tag == 0x0112:
+                        value = struct.unpack_from(endian + "H", tiff, entry + 8)[0]
+                        return value if 1 <= value <= 8 else 1
+                return 1
+            i += 2 + seg_len
+    except struct.error:
+        pass
+    return 1
+
+def _apply_orientation(arr: np.ndarray, orientation: int) -> np.ndarray:
+    # Same transforms as ImageOps.exif_transpose, but as numpy views
+    if orientation == 2:
+        return arr[:, ::-1]
+    if orientation == 3:
+        return arr[::-1, ::-1]
+    if orientation == 4:
+        return arr[::-1]
+    if orientation == 5:
+        return arr.swapaxes(0, 1)
+    if orientation == 6:
+        return np.rot90(arr, -1)
+    if orientation == 7:
+        return arr[::-1, ::-1].swapaxes(0, 1)
+    if orientation == 8:
+        return np.rot90(arr)
+    return arr
+
+def _scaling_for_height(buf: memoryview, target_height: int, orientation: int) -> Optional[Tuple[int, int]]:
+    # Smallest IDCT scaling factor that still yields >= target_height rows,
+    # so only a (cheap, downscaling) LANCZOS touch-up is left for make_sbs.
+    width, height = _TJ.decode_header(buf)[:2]
+    src_h = width if orientation >= 5 else height  # 5..8 swap axes
+    best: Optional[Tuple[int, Tuple[int, int]]] = None
+    for num, denom in _TJ.scaling_factors:
+        if num > denom:  # 9/8..2/1 upscale; never worth a bigger IDCT
+            continue
+        scaled_h = -(-src_h * num // denom)  # TJSCALED rounds up
+        if scaled_h >= target_height and (best is None or scaled_h < best[0]):
+            best = (scaled_h, (num, denom))
+    if best is None or best[1][0] == best[1][1]:
+        return None
+    return best[1]
+
+def _decode_jpeg_slice(buf: memoryview, exif_autorotate: bool = False, target_height: int = 0) -> Image.Image:
     if _TJ is not None:
-        # Default output is BGR in many builds → swap to RGB
-        arr = _TJ.decode(buf)           # shape: (H, W, 3) in BGR
-        if arr.ndim == 3 and arr.shape[2] == 3:
-            arr = arr[..., ::-1]        # BGR -> RGB
-            return Image.fromarray(arr, mode="RGB")
-        elif arr.ndim == 3 and arr.shape[2] == 4:
-            # If you ever get BGRA, convert to RGBA then to RGB
-            arr = arr[..., [2,1,0,3]]   # BGRA -> RGBA
-            return Image.fromarray(arr, mode="RGBA").convert("RGB")
-        else:
-            # grayscale etc.
-            return Image.fromarray(arr)
+        orientation = _exif_orientation(buf) if exif_autorotate else 1
+        scaling = _scaling_for_height(buf, target_height, orientation) if target_height > 0 else None
+        # libjpeg-turbo writes RGB directly (grayscale JPEGs are expanded too)
+        arr = _TJ.decode(buf, pixel_format=TJPF_RGB, scaling_factor=scaling)  # shape: (H, W, 3)
+        if orientation != 1:
+            # Rotate/flip as a view; fromarray below makes the only copy
+            arr = _apply_orientation(arr, orientation)
+        return Image.fromarray(arr, mode="RGB")
     # Fallback to Pillow
     with Image.open(BytesIO(buf)) as im:
+        if target_height > 0:
+            # Pillow's JPEG draft mode does the same 1/2..1/8 IDCT scaling
+            rotated = exif_autorotate and im.getexif().get(0x0112, 1) >= 5
+            im.draft("RGB", (target_height, 1) if rotated else (1, target_height))
         im.load()
-        return im.convert("RGB")
+        rgb = im.convert("RGB")
+    return ImageOps.exif_transpose(rgb) if exif_autorotate else rgb
 
-def read_two_frames_unreal_way(mpo_path: Path, exif_autorotate: bool) -> Tuple[Image.Image, Image.Image]:
+def read_two_frames_unreal_way(mpo_path: Path, exif_autorotate: bool, target_height: int = 0) -> Tuple[Image.Image, Image.Image]:
     with open(mpo_path, "rb") as f:
         mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         mv = memoryview(mm)
         try:
-            # first image: decode whole buffer (TurboJPEG ignores trailing data after its EOI)
-            left = _decode_jpeg_slice(mv)
-            # second image: slice from 2nd marker to 3rd/EOF
+            # scan first, then hand each decoder a tight slice
             off, cnt = parse_mpo_for_second_image(mv)
-            right = _decode_jpeg_slice(mv[off:off+cnt])
+            # first image: start of file up to the 2nd marker
+            left = _decode_jpeg_slice(mv[:off], exif_autorotate, target_height)
+            # second image: slice from 2nd marker to 3rd/EOF
+            right = _decode_jpeg_slice(mv[off:off+cnt], exif_autorotate, target_height)
         finally:
             # memoryview must be released before closing mmap on Windows
             mv.release()
             mm.close()
 
-    if exif_autorotate:
-        left = ImageOps.exif_transpose(left)
-        right = ImageOps.exif_transpose(right)
     return left, right
 
 # ---- SBS maker ----
-def make_sbs(left: Image.Image, right: Image.Image, target_height: int = 0) -> Image.Image:
+def make_sbs_array(left: Image.Image, right: Image.Image, target_height: int = 0) -> np.ndarray:
     # Upscale/Downscale only if needed
     def scale_to_h(im: Image.Image, H: int) -> Image.Image:
         if H <= 0 or im.height == H:
             return im
         W = int(round(im.width * (H / im.height)))
-        # TurboJPEG can scale natively only by 1/2, 1/4, 1/8; Pillow’s LANCZOS is fine here.
+        # Decoders already did the coarse 1/2..1/8 IDCT scaling; LANCZOS covers the rest.
         return im.resize((W, H), Image.Resampling.LANCZOS)
 
     if target_height and target_height > 0:
@@ -96,28 +178,108 @@ def make_sbs(left: Image.Image, right: Image.Image, target_height: int = 0) -> I
         L = scale_to_h(left, H)
         R = scale_to_h(right, H)
 
-    out = Image.new("RGB", (L.width + R.width, H))
-    out.paste(L, (0, 0))
-    out.paste(R, (L.width, 0))
-    return out
+    # Both eyes are H tall now: copy rows straight into one contiguous canvas
+    L_arr = np.asarray(L if L.mode == "RGB" else L.convert("RGB"))
+    R_arr = np.asarray(R if R.mode == "RGB" else R.convert("RGB"))
+    canvas = np.empty((H, L.width + R.width, 3), dtype=np.uint8)
+    canvas[:, :L.width] = L_arr
+    canvas[:, L.width:] = R_arr
+    return canvas
+
+def make_sbs(left: Image.Image, right: Image.Image, target_height: int = 0) -> Image.Image:
+    return Image.fromarray(make_sbs_array(left, right, target_height), mode="RGB")
+
+# 4:2:0 chroma (the de-facto JPEG default) at Q90: about half the chroma work and bytes of 4:4:4
+def save_sbs(left: Image.Image, right: Image.Image, out: Path, target_height: int = 0) -> None:
+    if _TJ is not None:
+        arr = make_sbs_array(left, right, target_height)
+        out.write_bytes(_TJ.encode(arr, quality=90, pixel_format=TJPF_RGB,
+                                   jpeg_subsample=TJSAMP_420, flags=TJFLAG_FASTDCT))
+        return
+    sbs = make_sbs(left, right, target_height)
+    sbs.save(out, "JPEG", quality=90, subsampling=2, optimize=False)
+
+# ---- libvips path: pixels stream through decode, join and encode once ----
+def _vips_load(buf: memoryview, exif_autorotate: bool, target_height: int = 0):
+    # Source.new_from_memory reads the slice in place (new_from_buffer would copy it)
+    source = _VIPS.Source.new_from_memory(buf)
+    im = _VIPS.Image.new_from_source(source, "", access="sequential")
+    orientation = im.get("orientation") if exif_autorotate and im.get_typeof("orientation") else 1
+    src_w, src_h = (im.height, im.width) if orientation >= 5 else (im.width, im.height)  # 5..8 swap axes
+    shrink = 1
+    if target_height > 0:
+        # jpegload shrink-on-load (1/2, 1/4, 1/8 in the IDCT), never below target_height rows;
+        # unlike TJSCALED, vips rounds the shrunk size down
+        shrink = next((k for k in (8, 4, 2) if src_h // k >= target_height), 1)
+    if orientation != 1:
+        # Rotation reads out of order -> reload with random access
+        im = _VIPS.Image.new_from_source(source, "", shrink=shrink).autorot()
+    elif shrink > 1:
+        im = _VIPS.Image.new_from_source(source, "", access="sequential", shrink=shrink)
+    if im.interpretation != "srgb":
+        im = im.colourspace("srgb")
+    # Full-size aspect: the shrunk width is rounded independently of the height
+    return im, src_w / src_h
+
+def _vips_fit_height(im, aspect: float, H: int):
+    # Same output size as make_sbs's scale_to_h
+    W = int(round(aspect * H))
+    if im.width == W and im.height == H:
+        return im
+    return im.resize(W / im.width, vscale=H / im.height)
+
+def _vips_join_save(left_buf: memoryview, right_buf: memoryview, out: Path, exif_autorotate: bool, target_height: int) -> None:
+    left, left_aspect = _vips_load(left_buf, exif_autorotate, target_height)
+    right, right_aspect = _vips_load(right_buf, exif_autorotate, target_height)
+
+    H = target_height if target_height and target_height > 0 else max(left.height, right.height)
+    left = _vips_fit_height(left, left_aspect, H)
+    right = _vips_fit_height(right, right_aspect, H)
+
+    sbs = left.join(right, "horizontal", expand=True)
+    # No metadata: the left eye's EXIF (Orientation, thumbnail) doesn't describe
+    # the SBS image, and the Pillow/TurboJPEG paths write none either
+    strip = {"keep": "none"} if _VIPS.at_least_libvips(8, 15) else {"strip": True}
+    sbs.jpegsave(str(out), Q=90, optimize_coding=True, subsample_mode="on", **strip)
+
+def make_sbs_vips(mpo_path: Path, out: Path, exif_autorotate: bool, target_height: int = 0) -> None:
+    with open(mpo_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(mm)
+        try:
+            off, cnt = parse_mpo_for_second_image(mv)
+            # vips reads straight from the mapping, so the whole pipeline
+            # (down to jpegsave) runs before the map is closed
+            _vips_join_save(mv[:off], mv[off:off+cnt], out, exif_autorotate, target_height)
+        finally:
+            # memoryview must be released before closing mmap on Windows
+            mv.release()
+            try:
+                mm.close()
+            except BufferError:
+                # a failed pipeline's traceback still pins a slice; GC closes the map
+                pass
 
 # ---- Gradio workflow with optional parallel batch ----
+# Top-level so ProcessPoolExecutor can pickle it
+def process_one(p: Path, outdir: Path, exif_autorotate: bool, target_height: int) -> str:
+    try:
+        out = outdir / f"{p.stem}_sbs.jpg"
+        if _VIPS is not None:
+            make_sbs_vips(p, out, exif_autorotate, target_height)
+            return f"OK: {p.name} → {out.name}"
+        left, right = read_two_frames_unreal_way(p, exif_autorotate, target_height)
+        save_sbs(left, right, out, target_height)
+        left.close(); right.close()
+        return f"OK: {p.name} → {out.name}"
+    except Exception as e:
+        return f"FAIL: {p.name} → {e}"
+
 def mpo_to_sbs(input_path: str, output_folder: str, exif_autorotate: bool, recursive: bool, target_height: int, workers: int) -> str:
     inp = Path(input_path)
     outdir = Path(output_folder)
     outdir.mkdir(parents=True, exist_ok=True)
 
-    def process_one(p: Path) -> str:
-        try:
-            left, right = read_two_frames_unreal_way(p, exif_autorotate)
-            sbs = make_sbs(left, right, target_height)
-            out = outdir / f"{p.stem}_sbs.jpg"
-            sbs.save(out, "JPEG", quality=92, subsampling=0)
-            left.close(); right.close()
-            return f"OK: {p.name} → {out.name}"
-        except Exception as e:
-            return f"FAIL: {p.name} → {e}"
-
     tasks: List[Path] = []
     if inp.is_file():
         if inp.suffix.lower() not in [".mpo", ".jpg", ".jpeg"]:
@@ -134,13 +296,18 @@ def mpo_to_sbs(input_path: str, output_folder: str, exif_autorotate: bool, recur
     logs: List[str] = []
     if len(tasks) == 1 or workers <= 1:
         for p in tasks:
-            logs.append(process_one(p))
+            logs.append(process_one(p, outdir, exif_autorotate, target_height))
     else:
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        # JPEG decode is in C (releases GIL) -> threads help
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+        if _TJ is not None or _VIPS is not None:
+            # JPEG decode is in C (releases GIL) -> threads help
+            Executor = ThreadPoolExecutor
+        else:
+            # Pillow-only: open/convert/EXIF hold the GIL -> use processes
+            Executor = ProcessPoolExecutor
         w = max(1, min(workers, os.cpu_count() or 4))
-        with ThreadPoolExecutor(max_workers=w) as ex:
-            futs = {ex.submit(process_one, p): p for p in tasks}
+        with Executor(max_workers=w) as ex:
+            futs = {ex.submit(process_one, p, outdir, exif_autorotate, target_height): p for p in tasks}
             for f in as_completed(futs):
                 logs.append(f.result())
 
@@ -149,6 +316,7 @@ def mpo_to_sbs(input_path: str, output_folder: str, exif_autorotate: bool, recur
 def main():
     default_workers = max(1, (os.cpu_count() or 4) // 2)
     turbo = "ON" if _TJ is not None else "OFF"
+    vips = "ON" if _VIPS is not None else "OFF"
     iface = gr.Interface(
         fn=mpo_to_sbs,
         inputs=[
@@ -157,11 +325,11 @@ def main():
             gr.Checkbox(label="Auto-apply EXIF Orientation", value=True),
             gr.Checkbox(label="Recursive (when input is a folder)", value=False),
             gr.Slider(label="Target Height (0 = keep largest)", minimum=0, maximum=4096, step=1, value=0),
-            gr.Slider(label=f"Workers (TurboJPEG {turbo})", minimum=1, maximum=32, step=1, value=default_workers),
+            gr.Slider(label=f"Workers (TurboJPEG {turbo}, libvips {vips})", minimum=1, maximum=32, step=1, value=default_workers),
         ],
         outputs=gr.Textbox(label="Status / Logs", lines=12),
         title="MPO → SBS JPG (Unreal markers, fast)",
-        description="Exact Unreal-style slicing. Uses TurboJPEG if available; else Pillow. Parallel for folders."
+        description="Exact Unreal-style slicing. Uses libvips or TurboJPEG if available; else Pillow. Parallel for folders."
     )
     iface.launch()
 